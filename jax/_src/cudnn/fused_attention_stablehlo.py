@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import partial, reduce
+from functools import lru_cache, partial, reduce
 import operator
 from typing import Optional
 import json
@@ -37,15 +37,100 @@ DType = jnp.dtype
 PRNGKey = jnp.ndarray
 
 def element_type_to_backend_config_type_mapping(dtype):
-  _element_type_to_backend_config_type_mapping = {
-    ir.BF16Type.get(): "BF16",
-    ir.F16Type.get(): "F16",
-  }
-  return _element_type_to_backend_config_type_mapping[dtype]
+  # dispatch on the MLIR type directly instead of building a dict of
+  # context-bound type singletons on every lowering
+  if ir.BF16Type.isinstance(dtype):
+    return "BF16"
+  if ir.F16Type.isinstance(dtype):
+    return "F16"
+  raise KeyError(dtype)
+
+# default (row-major) minor-to-major layouts only depend on the rank, the
+# attention operands and results are all rank 1 (scratch), 3 or 4
+_LAYOUT_BY_RANK = {rank: tuple(range(rank - 1, -1, -1)) for rank in range(6)}
 
 def default_layouts(*shapes):
-  return [range(len(shape) - 1, -1, -1) for shape in shapes]
+  return [_LAYOUT_BY_RANK[len(shape)] for shape in shapes]
+
+# b q_seq num_heads head_dim  -> Q
+# b kv_seq num_heads head_dim -> K
+# b kv_seq num_heads head_dim -> V
+# b num_heads q_seq kv_seq -> P
+# b q_seq num_heads head_dim -> O
+# bmm1: Q @ K -> P
+# bmm2: P @ V -> O
+# bmm2Grad1: P @ dO -> dV
+# bmm2Grad2: dO @ V -> dP
+# bmm1Grad1: dP @ Q -> dK
+# bmm1Grad2: dP @ K -> dQ
+# The parts of the backend config below never depend on the attention shape,
+# so they are built once at import time and shared by every lowering.
+_FMHA_ALGORITHM = {
+  "algo_id": "0",
+  "math_type": "TENSOR_OP_MATH",
+  "tuning_knobs": {"17": "1", "24": "0"},
+  "is_cudnn_frontend": True,
+  "workspace_size": "0",
+}
 
+_FMHA_INTERMEDIATE_LAYOUT = {
+  "dim_level_types": [],
+  "dim_unique": [],
+  "dim_ordered": [],
+  "minor_to_major": ["3", "2", "1", "0"],
+  "tiles": [],
+  "element_size_in_bits": "0",
+  "memory_space": "0",
+  "index_primitive_type": "PRIMITIVE_TYPE_INVALID",
+  "pointer_primitive_type": "PRIMITIVE_TYPE_INVALID",
+  "dynamic_shape_metadata_prefix_bytes": "0",
+}
+
+_FMHA_FWD_DOT_NUMBERS = {
+  "bmm1_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["3"],
+    "rhs_contracting_dimensions": ["3"],
+    "lhs_batch_dimensions": ["0", "2"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+  "bmm2_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["3"],
+    "rhs_contracting_dimensions": ["1"],
+    "lhs_batch_dimensions": ["0", "1"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+}
+
+_FMHA_BWD_DOT_NUMBERS = {
+  "bmm1_grad_gemm1_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["2"],
+    "rhs_contracting_dimensions": ["1"],
+    "lhs_batch_dimensions": ["0", "1"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+  "bmm1_grad_gemm2_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["3"],
+    "rhs_contracting_dimensions": ["1"],
+    "lhs_batch_dimensions": ["0", "1"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+  "bmm2_grad_gemm1_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["2"],
+    "rhs_contracting_dimensions": ["1"],
+    "lhs_batch_dimensions": ["0", "1"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+  "bmm2_grad_gemm2_dot_dimension_numbers": {
+    "lhs_contracting_dimensions": ["3"],
+    "rhs_contracting_dimensions": ["3"],
+    "lhs_batch_dimensions": ["0", "2"],
+    "rhs_batch_dimensions": ["0", "2"],
+  },
+}
+
+# Identical attention layers lower to identical configs, and every argument is
+# a plain Python value, so memoize the serialized JSON.
+@lru_cache(maxsize=128)
 def create_dot_product_attention_backend_config(batch,
                                                 num_heads,
                                                 seq_q,
@@ -57,93 +142,22 @@ def create_dot_product_attention_backend_config(batch,
                                                 is_flash_attention,
                                                 is_causal_mask,
                                                 is_bwd):
-  # b q_seq num_heads head_dim  -> Q
-  # b kv_seq num_heads head_dim -> K
-  # b kv_seq num_heads head_dim -> V
-  # b num_heads q_seq kv_seq -> P
-  # b q_seq num_heads head_dim -> O
-  # bmm1: Q @ K -> P
-  # bmm2: P @ V -> O
-  # bmm2Grad1: P @ dO -> dV
-  # bmm2Grad2: dO @ V -> dP
-  # bmm1Grad1: dP @ Q -> dK
-  # bmm1Grad2: dP @ K -> dQ
   cudnn_fmha_backend_config = {
-    "algorithm": {
-      "algo_id": "0",
-      "math_type": "TENSOR_OP_MATH",
-      "tuning_knobs": {"17": "1", "24": "0"},
-      "is_cudnn_frontend": True,
-      "workspace_size": "0",
-    },
+    "algorithm": _FMHA_ALGORITHM,
     "fmha_scale": fmha_scale,
     "dropout_rate": dropout_rate,
     "intermediate_tensor_shape": {
-      "element_type": element_type_to_backend_config_type_mapping(dtype),
+      "element_type": dtype,
       "dimensions": [str(batch), str(num_heads), str(seq_q), str(seq_kv)],
       "tuple_shapes": [],
-      "layout": {
-        "dim_level_types": [],
-        "dim_unique": [],
-        "dim_ordered": [],
-        "minor_to_major": ["3", "2", "1", "0"],
-        "tiles": [],
-        "element_size_in_bits": "0",
-        "memory_space": "0",
-        "index_primitive_type": "PRIMITIVE_TYPE_INVALID",
-        "pointer_primitive_type": "PRIMITIVE_TYPE_INVALID",
-        "dynamic_shape_metadata_prefix_bytes": "0",
-      },
+      "layout": _FMHA_INTERMEDIATE_LAYOUT,
       "is_dynamic_dimension": [False, False, False, False],
     },
     "seed": seed,
     "is_flash_attention": is_flash_attention,
     "is_causal_mask": is_causal_mask,
+    **(_FMHA_BWD_DOT_NUMBERS if is_bwd else _FMHA_FWD_DOT_NUMBERS),
   }
-  fwd_dot_number = {
-    "bmm1_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["3"],
-      "rhs_contracting_dimensions": ["3"],
-      "lhs_batch_dimensions": ["0", "2"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-    "bmm2_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["3"],
-      "rhs_contracting_dimensions": ["1"],
-      "lhs_batch_dimensions": ["0", "1"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-  }
-  bwd_dot_number = {
-    "bmm1_grad_gemm1_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["2"],
-      "rhs_contracting_dimensions": ["1"],
-      "lhs_batch_dimensions": ["0", "1"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-    "bmm1_grad_gemm2_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["3"],
-      "rhs_contracting_dimensions": ["1"],
-      "lhs_batch_dimensions": ["0", "1"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-    "bmm2_grad_gemm1_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["2"],
-      "rhs_contracting_dimensions": ["1"],
-      "lhs_batch_dimensions": ["0", "1"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-    "bmm2_grad_gemm2_dot_dimension_numbers": {
-      "lhs_contracting_dimensions": ["3"],
-      "rhs_contracting_dimensions": ["3"],
-      "lhs_batch_dimensions": ["0", "2"],
-      "rhs_batch_dimensions": ["0", "2"],
-    },
-  }
-  if is_bwd:
-    cudnn_fmha_backend_config = {**cudnn_fmha_backend_config, **bwd_dot_number}
-  else:
-    cudnn_fmha_backend_config = {**cudnn_fmha_backend_config, **fwd_dot_number}
 
   backend_config = {
     "operation_queue_id":"0",
@@ -178,15 +192,23 @@ _custom_name_maps = {
 def get_custom_call_name(has_bias, has_mask, has_dropout, is_bwd):
   return _custom_name_maps[(is_bwd, has_dropout, has_mask, has_bias)]
 
+# Only support fp16 and bf16 here
+_ALLOWED_DTYPES = frozenset({jnp.dtype(jnp.float16), jnp.dtype(jnp.bfloat16)})
+# XLA does not register an fp8 cuDNN fMHA custom call yet
+_FP8_DTYPES = frozenset({jnp.dtype(jnp.float8_e4m3fn), jnp.dtype(jnp.float8_e5m2)})
+
 def check_qkv_layout(query, key, value):
   assert len(query.shape) == len(key.shape) == len(value.shape) == 4, \
     "query, key and value should have rank 4."
 
-  # Only support fp16 and bf16 here
   query_dtype = query.dtype
   key_dtype = key.dtype
   value_dtype = value.dtype
-  assert query_dtype == key_dtype == value_dtype and query_dtype in [jnp.float16, jnp.bfloat16], \
+  if any(dt in _FP8_DTYPES for dt in (query_dtype, key_dtype, value_dtype)):
+    raise NotImplementedError(
+      "fp8 fused attention is not supported yet, cast query, key and value "
+      "to float16 or bfloat16.")
+  assert query_dtype == key_dtype == value_dtype and query_dtype in _ALLOWED_DTYPES, \
     "query, key and value should have same dtype and should be float16 or bfloat16"
 
   q_batch, q_seq_len, q_num_heads, q_head_dim = query.shape
@@ -200,7 +222,7 @@ def check_qkv_layout(query, key, value):
       "query should have layout [batch, q_seq, num_heads, head_dim], " \
       "key and value should have layout [batch, kv_seq, num_heads, head_dim].")
 
-def check_is_flash_attention(query, key):
+def check_is_flash_attention(query, key, is_causal_mask):
   batch, q_seq_len, num_heads, head_dim = query.shape
   _, kv_sqe_len, _, _ = key.shape
   is_cross_attention = q_seq_len != kv_sqe_len
@@ -208,9 +230,14 @@ def check_is_flash_attention(query, key):
   if q_seq_len > 512 and kv_sqe_len > 512 and head_dim in [64, 128]:
     # check if flash attention is supported
     is_flash_attention = True
-  elif q_seq_len <= 512 and kv_sqe_len <= 512 and head_dim == 64:
-    # check if regular fused attention is supported
+  elif q_seq_len <= 512 and kv_sqe_len <= 512 and head_dim == 64 and not is_causal_mask:
+    # short sequences with head dim 64 are served by regular fused attention,
+    # which can not generate a causal mask
     is_flash_attention = False
+  elif head_dim in [64, 128] and q_seq_len % 64 == 0 and kv_sqe_len % 64 == 0:
+    # flash attention also covers head dim 128, causal mask and mixed
+    # short/long cross attention if both sequence lengths are multiples of 64
+    is_flash_attention = True
   else:
     raise NotImplementedError(
       f"Unsupported sequence length Q {q_seq_len}, KV {kv_sqe_len} and head dim {head_dim}.")
@@ -228,24 +255,48 @@ def check_cudnn_version(is_flash_attention, is_cross_attention):
   elif not is_flash_attention and cuda_versions.cudnn_get_version() < 8901:
     raise RuntimeError("JAX requires cuDNN >= 8.9.1 to use fused attention.")
 
+@lru_cache(maxsize=None)
+def _get_local_gpu():
+  # first local GPU, None if there is none. Looked up once per process since
+  # enumerating devices on every trace or lowering is not free.
+  try:
+    device, *_ = jax.local_devices(backend="gpu")
+  except RuntimeError:
+    return None
+  return device
+
+def check_compute_capability(min_capability):
+  # cuDNN picks the Ampere or Hopper kernel itself, but has no fused attention
+  # kernel for older architectures
+  device = _get_local_gpu()
+  if device is None:
+    # no local GPU, e.g. when lowering for export, leave the check to XLA
+    return
+  capability = tuple(int(x) for x in device.compute_capability.split("."))
+  if capability < min_capability:
+    raise RuntimeError(
+      "JAX requires a GPU with compute capability >= "
+      f"{'.'.join(map(str, min_capability))} to use fused attention, "
+      f"but got {device.compute_capability}.")
+
 def _dot_product_attention_fwd(query, key, value, bias, mask,
-  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
   output, _ = _dot_product_attention_fwd_p_wrapper.bind(
     query, key, value, bias, mask, scale=scale, seed=seed, dropout_rate=dropout_rate,
     variadic_args=variadic_args, is_flash_attention=is_flash_attention,
-    is_causal_mask=is_causal_mask)
+    is_causal_mask=is_causal_mask, split_kv=split_kv)
   return output
 
 def _dot_product_attention_fwd_rule(query, key, value, bias, mask,
-  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
   output, activation = _dot_product_attention_fwd_p_wrapper.bind(
     query, key, value, bias, mask, scale=scale, seed=seed, dropout_rate=dropout_rate,
     variadic_args=variadic_args, is_flash_attention=is_flash_attention,
-    is_causal_mask=is_causal_mask)
+    is_causal_mask=is_causal_mask, split_kv=split_kv)
   res = (query, key, value, bias, mask, activation, output)
   return output, res
 
-def _dot_product_attention_bwd_rule(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, res, grad_output):
+def _dot_product_attention_bwd_rule(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv, res, grad_output):
   query, key, value, bias, mask, activation, fwd_output = res
   grad_query, grad_key, grad_value = _dot_product_attention_bwd_p_wrapper.bind(
     query, key, value, bias, mask, activation, fwd_output, grad_output,
@@ -255,13 +306,67 @@ def _dot_product_attention_bwd_rule(scale, seed, dropout_rate, variadic_args, is
   grads = (grad_query, grad_key, grad_value, None, None)
   return grads
 
+def _get_sm_count():
+  # SM count of the first local GPU, 0 if there is none
+  device = _get_local_gpu()
+  return 0 if device is None else device.core_count
+
+def get_split_kv_factor(batch, num_heads, q_seq_len, kv_seq_len):
+  # flash attention launches one block per (batch, head, 128 query rows), so
+  # small batch decoding leaves most SMs idle. Return how many kv chunks to
+  # compute in parallel to fill one wave, 1 means no split.
+  if cuda_versions is None or cuda_versions.cudnn_get_version() < 8904:
+    # kv chunks turn the call into flash cross attention
+    return 1
+  q_tiles = -(-q_seq_len // 128)
+  split = _get_sm_count() // (batch * num_heads * q_tiles)
+  # every kv chunk should still be a multiple of 64 and at least 512 long
+  while split > 1 and (kv_seq_len % (split * 64) or kv_seq_len // split < 512):
+    split -= 1
+  return max(split, 1)
+
+def _dot_product_attention_fwd_split_kv(query, key, value, bias, mask, split,
+  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
+  # FlashDecoding: fold kv chunks into the batch dim, attend every chunk with
+  # the same query in one call and merge the partial outputs with their
+  # softmax stats (logsumexp).
+  batch, q_seq_len, num_heads, head_dim = query.shape
+  _, kv_seq_len, _, _ = key.shape
+  # chunks are batch major (b * split + s), so key and value are only reshaped
+  chunk_shape = (batch * split, kv_seq_len // split, num_heads, head_dim)
+  query = jnp.broadcast_to(query[:, None], (batch, split, *query.shape[1:])).reshape(
+    (batch * split, q_seq_len, num_heads, head_dim))
+  key, value = [jnp.reshape(x, chunk_shape) for x in (key, value)]
+  output, activation = _dot_product_attention_fwd_p.bind(
+    query, key, value, bias, mask, scale=scale, seed=seed, dropout_rate=dropout_rate,
+    variadic_args=variadic_args, is_flash_attention=is_flash_attention,
+    is_causal_mask=is_causal_mask, split_kv=split_kv)
+  # (batch, split, num_heads, q_seq)
+  activation = jnp.reshape(activation, (batch, split, num_heads, q_seq_len))
+  softmax_stat = jax.nn.logsumexp(activation, axis=1)
+  # (batch, split, q_seq, num_heads, 1)
+  weights = jnp.exp(activation - softmax_stat[:, None]).transpose((0, 1, 3, 2))[..., None]
+  output = jnp.reshape(output, (batch, split, q_seq_len, num_heads, head_dim))
+  output = jnp.sum(weights * output.astype(jnp.float32), axis=1).astype(query.dtype)
+  return output, softmax_stat
+
 def _dot_product_attention_fwd_impl(query, key, value, bias, mask,
-  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
   # args: {Q, K, V, mask*, bias*}
+  if (split_kv and is_flash_attention and not is_causal_mask and dropout_rate == 0
+      and variadic_args == (False, False)):
+    batch, q_seq_len, num_heads, _ = query.shape
+    split = get_split_kv_factor(batch, num_heads, q_seq_len, key.shape[1])
+    if split > 1:
+      return _dot_product_attention_fwd_split_kv(
+        query, key, value, bias, mask, split, scale=scale, seed=seed,
+        dropout_rate=dropout_rate, variadic_args=variadic_args,
+        is_flash_attention=is_flash_attention, is_causal_mask=is_causal_mask,
+        split_kv=split_kv)
   output, activation = _dot_product_attention_fwd_p.bind(
     query, key, value, bias, mask, scale=scale, seed=seed, dropout_rate=dropout_rate,
     variadic_args=variadic_args, is_flash_attention=is_flash_attention,
-    is_causal_mask=is_causal_mask)
+    is_causal_mask=is_causal_mask, split_kv=split_kv)
   return output, activation
 
 def _dot_product_attention_bwd_impl(query, key, value, bias, mask, activation, fwd_output, grad_output,
@@ -275,15 +380,16 @@ def _dot_product_attention_bwd_impl(query, key, value, bias, mask, activation, f
   return grads
 
 def _dot_product_attention_fwd_abstract(query, key, value, bias, mask,
-  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
   query_dtype = dtypes.canonicalize_dtype(query.dtype)
   batch, q_seq_len, num_heads, head_dim = query.shape
   _, kv_seq_len, _, _ = key.shape
   output_shape = (batch, q_seq_len, num_heads, head_dim)
   activation_shape = (batch, num_heads, q_seq_len, kv_seq_len)
   softmax_stat_shape = (batch, num_heads, q_seq_len)
-  if q_seq_len > 512:
-    # is flash attention
+  if is_flash_attention:
+    # flash attention only saves the fp32 per-row softmax stat (logsumexp) and
+    # recomputes the attention matrix in the bwd pass
     return (
       core.ShapedArray(output_shape, query_dtype),  # output
       core.ShapedArray(softmax_stat_shape, jnp.float32),  # softmax_stat
@@ -295,33 +401,32 @@ def _dot_product_attention_fwd_abstract(query, key, value, bias, mask,
 
 def _dot_product_attention_bwd_abstract(query, key, value, bias, mask, activation, fwd_output, grad_output,
   *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  # query, key and value are checked to share one dtype in check_qkv_layout
   query_dtype = dtypes.canonicalize_dtype(query.dtype)
-  key_dtype = dtypes.canonicalize_dtype(key.dtype)
-  value_dtype = dtypes.canonicalize_dtype(value.dtype)
 
   return (
     core.ShapedArray(
         query.shape, query_dtype
     ),  # grad query
     core.ShapedArray(
-        key.shape, key_dtype
+        key.shape, query_dtype
     ),  # grad key
     core.ShapedArray(
-        value.shape, value_dtype
+        value.shape, query_dtype
     ),  # part value
   )
 
 def _dot_product_attention_fwd_cuda_lowering(ctx, query, key, value, bias, mask,
-  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
+  # query, key and value share one element type, see check_qkv_layout
   query_type = ir.RankedTensorType(query.type)
-  query_shape = query_type.shape
-  key_type = ir.RankedTensorType(key.type)
-  key_shape = key_type.shape
-  value_type = ir.RankedTensorType(value.type)
-  value_shape = value_type.shape
-
-  batch, q_seq_len, num_heads, head_dim = query_shape
-  _, kv_seq_len, _, _ = key_shape
+  element_type = query_type.element_type
+  batch, q_seq_len, num_heads, head_dim = query_type.shape
+  _, kv_seq_len, _, _ = ir.RankedTensorType(key.type).shape
+  # check if cuDNN is installed and if cuDNN version is sufficient
+  check_cudnn_version(is_flash_attention, q_seq_len != kv_seq_len)
+  # check if the GPU architecture has cuDNN fused attention kernels
+  check_compute_capability((8, 0))
 
   output_shape = (batch, num_heads, q_seq_len, head_dim)
   output_layout = (3, 1, 2, 0)
@@ -331,7 +436,7 @@ def _dot_product_attention_fwd_cuda_lowering(ctx, query, key, value, bias, mask,
   scratch_shape = (0,)
   scratch_type = ir.IntegerType.get_unsigned(8)
   # get backend config
-  backend_config = create_dot_product_attention_backend_config(batch, num_heads, q_seq_len, kv_seq_len, query_type.element_type, scale, seed, dropout_rate, is_flash_attention, is_causal_mask, False)
+  backend_config = create_dot_product_attention_backend_config(batch, num_heads, q_seq_len, kv_seq_len, element_type_to_backend_config_type_mapping(element_type), scale, seed, dropout_rate, is_flash_attention, is_causal_mask, False)
   # {Q, K, V, mask*, bias*}
   # {output, scratch, activation*}
   has_dropout = dropout_rate > 0
@@ -345,16 +450,16 @@ def _dot_product_attention_fwd_cuda_lowering(ctx, query, key, value, bias, mask,
   # create output types and layouts
   if is_flash_attention:
     result_types = [
-      ir.RankedTensorType.get(output_shape, query_type.element_type),
+      ir.RankedTensorType.get(output_shape, element_type),
       ir.RankedTensorType.get(scratch_shape, scratch_type),
       ir.RankedTensorType.get(softmax_stat_shape, ir.F32Type.get()),
     ]
     result_layouts = [output_layout] + default_layouts(scratch_shape, softmax_stat_shape)
   else:
     result_types = [
-      ir.RankedTensorType.get(output_shape, query_type.element_type),
+      ir.RankedTensorType.get(output_shape, element_type),
       ir.RankedTensorType.get(scratch_shape, scratch_type),
-      ir.RankedTensorType.get(activation_shape, query_type.element_type),
+      ir.RankedTensorType.get(activation_shape, element_type),
     ]
     result_layouts = [output_layout] + default_layouts(scratch_shape, activation_shape)
   # create custom call here
@@ -371,20 +476,16 @@ def _dot_product_attention_fwd_cuda_lowering(ctx, query, key, value, bias, mask,
   return [hlo.transpose(out.results[0], output_transpose_perm), out.results[2]]
 
 def _dot_product_attention_bwd_cuda_lowering(ctx, query, key, value, bias, mask, activation, fwd_output, grad_output,
-  scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  # query, key and value share one element type, see check_qkv_layout
   query_type = ir.RankedTensorType(query.type)
-  query_shape = query_type.shape
-  key_type = ir.RankedTensorType(key.type)
-  key_shape = key_type.shape
-  value_type = ir.RankedTensorType(value.type)
-  value_shape = value_type.shape
+  element_type = query_type.element_type
+  batch, q_seq_len, num_heads, head_dim = query_type.shape
+  _, kv_seq_len, _, _ = ir.RankedTensorType(key.type).shape
+  check_cudnn_version(is_flash_attention, q_seq_len != kv_seq_len)
+  check_compute_capability((8, 0))
   activation_type = ir.RankedTensorType(activation.type)
   activation_shape = activation_type.shape
-  grad_output_type = ir.RankedTensorType(grad_output.type)
-  grad_output_shape = grad_output_type.shape
-
-  batch, q_seq_len, num_heads, head_dim = query_shape
-  _, kv_seq_len, _, _ = key_shape
   scratch_shape = (0,)
   scratch_type = ir.IntegerType.get_unsigned(8)
 
@@ -394,7 +495,7 @@ def _dot_product_attention_bwd_cuda_lowering(ctx, query, key, value, bias, mask,
   softmax_sum_shape = (batch, num_heads, q_seq_len)
   grad_layout = (3, 1, 2, 0)
   grad_transpose_perm = mlir.dense_int_array((0, 2, 1, 3))
-  backend_config = create_dot_product_attention_backend_config(batch, num_heads, q_seq_len, kv_seq_len, query_type.element_type, scale, seed, dropout_rate, is_flash_attention, is_causal_mask, True)
+  backend_config = create_dot_product_attention_backend_config(batch, num_heads, q_seq_len, kv_seq_len, element_type_to_backend_config_type_mapping(element_type), scale, seed, dropout_rate, is_flash_attention, is_causal_mask, True)
   # {Q, K, V, activation, dO, mask*, bias*, O*}
   # {dQ, dK, dV, d_S*, softmax_sum*, d_Q_accum*, scratch, dbias*}
   has_dropout = dropout_rate > 0
@@ -414,9 +515,9 @@ def _dot_product_attention_bwd_cuda_lowering(ctx, query, key, value, bias, mask,
   # create output types and layouts
   if is_flash_attention:
     result_types = [
-      ir.RankedTensorType.get(grad_query_shape, query_type.element_type), # grad query
-      ir.RankedTensorType.get(grad_key_shape, key_type.element_type), # grad key
-      ir.RankedTensorType.get(grad_value_shape, value_type.element_type), # grad value
+      ir.RankedTensorType.get(grad_query_shape, element_type), # grad query
+      ir.RankedTensorType.get(grad_key_shape, element_type), # grad key
+      ir.RankedTensorType.get(grad_value_shape, element_type), # grad value
       ir.RankedTensorType.get(softmax_sum_shape, ir.F32Type.get()), # softmax_sum
       ir.RankedTensorType.get(grad_query_shape, ir.F32Type.get()), # d_Q_accum
       ir.RankedTensorType.get(scratch_shape, scratch_type), # scratch
@@ -424,9 +525,9 @@ def _dot_product_attention_bwd_cuda_lowering(ctx, query, key, value, bias, mask,
     result_layouts = [grad_layout, grad_layout, grad_layout] + default_layouts(softmax_sum_shape, grad_query_shape, scratch_shape)
   else:
     result_types = [
-      ir.RankedTensorType.get(grad_query_shape, query_type.element_type), # grad query
-      ir.RankedTensorType.get(grad_key_shape, key_type.element_type), # grad key
-      ir.RankedTensorType.get(grad_value_shape, value_type.element_type), # grad value
+      ir.RankedTensorType.get(grad_query_shape, element_type), # grad query
+      ir.RankedTensorType.get(grad_key_shape, element_type), # grad key
+      ir.RankedTensorType.get(grad_value_shape, element_type), # grad value
       ir.RankedTensorType.get(activation_shape, activation_type.element_type), # dS
       ir.RankedTensorType.get(scratch_shape, scratch_type), # scratch
     ]
@@ -444,6 +545,53 @@ def _dot_product_attention_bwd_cuda_lowering(ctx, query, key, value, bias, mask,
           hlo.transpose(out.results[1], grad_transpose_perm),
           hlo.transpose(out.results[2], grad_transpose_perm)]
 
+# cpu fallback
+def _dot_product_attention_xla(query, key, value, bias, mask,
+  scale, dropout_rate, variadic_args, is_causal_mask):
+  # plain XLA decomposition of the fused attention, returns the output and
+  # the softmax stat (logsumexp) and probabilities in float32
+  if dropout_rate > 0:
+    # dot_product_attention rejects dropout without cuDNN, this only triggers
+    # when a cuDNN enabled jaxlib lowers for CPU
+    raise NotImplementedError("Dropout is only supported by the cuDNN lowering.")
+  has_bias, has_mask = variadic_args
+  _, q_seq_len, _, _ = query.shape
+  _, kv_seq_len, _, _ = key.shape
+  logits = jnp.einsum('bqhd,bkhd->bhqk', query, key,
+                      preferred_element_type=jnp.float32) * scale
+  if has_bias:
+    logits = logits + bias.astype(jnp.float32)
+  large_negative_number = jnp.finfo(jnp.float32).min
+  if has_mask:
+    logits = jnp.where(mask != 0, logits, large_negative_number)
+  if is_causal_mask:
+    row_idx = jax.lax.broadcasted_iota(jnp.int32, (q_seq_len, kv_seq_len), 0)
+    col_idx = jax.lax.broadcasted_iota(jnp.int32, (q_seq_len, kv_seq_len), 1)
+    logits = jnp.where(row_idx >= col_idx, logits, large_negative_number)
+  softmax_stat = jax.nn.logsumexp(logits, axis=-1)
+  probs = jnp.exp(logits - softmax_stat[..., None])
+  output = jnp.einsum('bhqk,bkhd->bqhd', probs, value,
+                      preferred_element_type=jnp.float32).astype(query.dtype)
+  return output, softmax_stat, probs
+
+def _dot_product_attention_fwd_xla(query, key, value, bias, mask,
+  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
+  output, softmax_stat, probs = _dot_product_attention_xla(
+    query, key, value, bias, mask, scale, dropout_rate, variadic_args, is_causal_mask)
+  # match the residual of the cuDNN kernel that would have been picked
+  if is_flash_attention:
+    return output, softmax_stat
+  return output, probs.astype(query.dtype)
+
+def _dot_product_attention_bwd_xla(query, key, value, bias, mask, activation, fwd_output, grad_output,
+  *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+  # recompute the attention instead of consuming the cuDNN residuals
+  _, attention_vjp = jax.vjp(
+    lambda query, key, value: _dot_product_attention_xla(
+      query, key, value, bias, mask, scale, dropout_rate, variadic_args, is_causal_mask)[0],
+    query, key, value)
+  return attention_vjp(grad_output)
+
 # batcher
 def _check_valid_batch_dims(bdims):
   for dim in bdims:
@@ -451,16 +599,24 @@ def _check_valid_batch_dims(bdims):
       raise NotImplementedError("Currently only support batch_dim in [0, None], " \
       f"but got {dim=}")
 
-def _dot_product_attention_fwd_batcher(batched_args, batch_dims, *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
+def _broadcast_unbatched_args(batched_args, batch_dims, is_present):
+  # broadcast operands that are not batched (e.g. a key/value shared by a batch
+  # of queries) so every vmapped attention is still lowered to one cuDNN call
+  size = next(arg.shape[bdim] for arg, bdim in zip(batched_args, batch_dims)
+              if bdim is not None)
+  return [batching.bdim_at_front(arg, bdim, size) if present else arg
+          for arg, bdim, present in zip(batched_args, batch_dims, is_present)]
+
+def _dot_product_attention_fwd_batcher(batched_args, batch_dims, *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv):
   _check_valid_batch_dims(batch_dims)
-  query, key, value, bias, mask = batched_args
-  query_bdim = batch_dims[0]
-  out_bdims = query_bdim, query_bdim
+  has_bias, has_mask = variadic_args
+  query, key, value, bias, mask = _broadcast_unbatched_args(
+    batched_args, batch_dims, (True, True, True, has_bias, has_mask))
+  out_bdims = 0, 0
 
   *batch_tuple, q_seq_len, num_heads, head_dim = query.shape
   *_, kv_seq_len, _, _ = key.shape
   new_batch = reduce(operator.mul, batch_tuple)
-  has_bias, has_mask = variadic_args
   # reshape to 4D shape
   query = jnp.reshape(query, (new_batch, q_seq_len, num_heads, head_dim))
   key = jnp.reshape(key, (new_batch, kv_seq_len, num_heads, head_dim))
@@ -474,7 +630,7 @@ def _dot_product_attention_fwd_batcher(batched_args, batch_dims, *, scale, seed,
     query, key, value, bias, mask,
     scale=scale, seed=seed, dropout_rate=dropout_rate,
     variadic_args=variadic_args, is_flash_attention=is_flash_attention,
-    is_causal_mask=is_causal_mask)
+    is_causal_mask=is_causal_mask, split_kv=split_kv)
 
   # reshape to original shape
   output = jnp.reshape(output, (*batch_tuple, q_seq_len, num_heads, head_dim))
@@ -486,14 +642,14 @@ def _dot_product_attention_fwd_batcher(batched_args, batch_dims, *, scale, seed,
 
 def _dot_product_attention_bwd_batcher(batched_args, batch_dims, *, scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask):
   _check_valid_batch_dims(batch_dims)
-  query, key, value, bias, mask, activation, fwd_output, grad_output = batched_args
-  query_bdim = batch_dims[0]
-  out_bdims = query_bdim, query_bdim, query_bdim
+  has_bias, has_mask = variadic_args
+  query, key, value, bias, mask, activation, fwd_output, grad_output = _broadcast_unbatched_args(
+    batched_args, batch_dims, (True, True, True, has_bias, has_mask, True, True, True))
+  out_bdims = 0, 0, 0
 
   *batch_tuple, q_seq_len, num_heads, head_dim = query.shape
   *_, kv_seq_len, _, _ = key.shape
   new_batch = reduce(operator.mul, batch_tuple)
-  has_bias, has_mask = variadic_args
   # reshape to 4D shape
   query = jnp.reshape(query, (new_batch, q_seq_len, num_heads, head_dim))
   key = jnp.reshape(key, (new_batch, kv_seq_len, num_heads, head_dim))
@@ -556,7 +712,7 @@ def _check_qkv_bias_mask_spec(query_spec, key_spec, value_spec, bias_spec, mask_
       raise ValueError("Sharding on mask sequence dim is not allowed.")
 
 # fwd custom partition
-def _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args):
+def _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args, is_flash_attention):
   # only sharding on batch and num_head dim is allowed
   # (*batch, q_seq, num_head, head)
   query_spec = _get_padded_spec(arg_shapes[0])
@@ -571,19 +727,24 @@ def _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args):
   out_sharding = NamedSharding(mesh, PartitionSpec(*query_spec))
   # activation sharding
   *batch_spec, q_seq_spec, num_head_spec, head_spec = query_spec
-  activation_sharding = NamedSharding(mesh, PartitionSpec(*batch_spec, num_head_spec, q_seq_spec, None))
+  if is_flash_attention:
+    # softmax stat has layout (*batch, num_head, q_seq)
+    activation_sharding = NamedSharding(mesh, PartitionSpec(*batch_spec, num_head_spec, q_seq_spec))
+  else:
+    activation_sharding = NamedSharding(mesh, PartitionSpec(*batch_spec, num_head_spec, q_seq_spec, None))
   return (out_sharding, activation_sharding)
 
-_dot_product_attention_fwd_lower = custom_partitioning(_dot_product_attention_fwd_impl, static_argnums=(5,6,7,8,9,10))
-def _dot_product_attention_fwd_infer_sharding_from_operands(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, mesh, arg_shapes, result_shape):
-  return _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args)
+_dot_product_attention_fwd_lower = custom_partitioning(_dot_product_attention_fwd_impl, static_argnums=(5,6,7,8,9,10,11))
+def _dot_product_attention_fwd_infer_sharding_from_operands(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv, mesh, arg_shapes, result_shape):
+  return _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args, is_flash_attention)
 
-def _dot_product_attention_fwd_partition(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, mesh, arg_shapes, result_shape):
+def _dot_product_attention_fwd_partition(scale, seed, dropout_rate, variadic_args, is_flash_attention, is_causal_mask, split_kv, mesh, arg_shapes, result_shape):
   # args sharding
   arg_shardings = tuple([arg_i.sharding for arg_i in arg_shapes])
-  out_shardings = _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args)
+  out_shardings = _infer_fwd_output_sharding(mesh, arg_shapes, variadic_args, is_flash_attention)
   impl = partial(_dot_product_attention_fwd_impl, scale=scale, seed=seed, dropout_rate=dropout_rate,
-                variadic_args=variadic_args, is_flash_attention=is_flash_attention, is_causal_mask=is_causal_mask)
+                variadic_args=variadic_args, is_flash_attention=is_flash_attention, is_causal_mask=is_causal_mask,
+                split_kv=split_kv)
   return mesh, impl, out_shardings, arg_shardings
 
 # bwd custom partition
@@ -628,6 +789,12 @@ mlir.register_lowering(
   platform="cuda",
 )
 
+mlir.register_lowering(
+  _dot_product_attention_fwd_p,
+  mlir.lower_fun(_dot_product_attention_fwd_xla, multiple_results=True),
+  platform="cpu",
+)
+
 _dot_product_attention_fwd_p_wrapper = core.Primitive("dot_product_attention_fwd_wrapper")
 _dot_product_attention_fwd_p_wrapper.multiple_results = True
 _dot_product_attention_fwd_p_wrapper.def_impl(_dot_product_attention_fwd_impl)
@@ -645,6 +812,12 @@ mlir.register_lowering(
   platform="cuda",
 )
 
+mlir.register_lowering(
+  _dot_product_attention_bwd_p,
+  mlir.lower_fun(_dot_product_attention_bwd_xla, multiple_results=True),
+  platform="cpu",
+)
+
 _dot_product_attention_bwd_p_wrapper = core.Primitive("dot_product_attention_bwd_wrapper")
 _dot_product_attention_bwd_p_wrapper.multiple_results = True
 _dot_product_attention_bwd_p_wrapper.def_impl(_dot_product_attention_bwd_impl)
@@ -673,7 +846,7 @@ dispatch.prim_requires_devices_during_lowering.add(_dot_product_attention_fwd_p_
 dispatch.prim_requires_devices_during_lowering.add(_dot_product_attention_bwd_p)
 dispatch.prim_requires_devices_during_lowering.add(_dot_product_attention_bwd_p_wrapper)
 
-@partial(jax.custom_vjp, nondiff_argnums=(5, 6, 7, 8, 9, 10))
+@partial(jax.custom_vjp, nondiff_argnums=(5, 6, 7, 8, 9, 10, 11))
 def _dot_product_attention(query: Array,
                             key: Array,
                             value: Array,
@@ -684,11 +857,13 @@ def _dot_product_attention(query: Array,
                             dropout_rate: float,
                             variadic_args: tuple[bool, ...],
                             is_flash_attention: bool,
-                            is_causal_mask: bool):
+                            is_causal_mask: bool,
+                            split_kv: bool):
   output = _dot_product_attention_fwd(
     query, key, value, bias, mask,
     scale=scale, seed=seed, dropout_rate=dropout_rate, variadic_args=variadic_args,
-    is_flash_attention=is_flash_attention, is_causal_mask=is_causal_mask)
+    is_flash_attention=is_flash_attention, is_causal_mask=is_causal_mask,
+    split_kv=split_kv)
   return output
 
 # _dot_product_attention_fwd must have the same func signature as _dot_product_attention
@@ -704,7 +879,8 @@ def dot_product_attention(query: Array,
                           scale: float = 1.0,
                           is_causal_mask: bool = False,
                           seed: int = 42,
-                          dropout_rate: float = 0.):
+                          dropout_rate: float = 0.,
+                          split_kv: bool = False):
   """Computes dot-product attention given query, key, and value.
   This is the core function for applying attention based on
   https://arxiv.org/abs/1706.03762. It calculates the attention weights given
@@ -713,6 +889,9 @@ def dot_product_attention(query: Array,
   b q_seq num_heads head_dim  -> Q
   b kv_seq num_heads head_dim -> K
   b kv_seq num_heads head_dim -> V
+  On CPU the attention is computed by a plain XLA decomposition. It accepts
+  the same dtypes, sequence lengths and head dims as the cuDNN kernels, but
+  does not support dropout.
   Args:
     query: queries for calculating attention with shape of `[batch, q_length,
     num_heads, qk_depth_per_head]`.
@@ -725,20 +904,29 @@ def dot_product_attention(query: Array,
     mask: mask used mask out logits with shape of `[batch, num_heads,
     q_length, kv_length]`.
     scale: scale for the query.
-    dropout_rate: dropout rate.
+    is_causal_mask: whether to apply a causal mask, generated by the kernel.
+    seed: seed of the cuDNN dropout RNG, only used if dropout_rate > 0.
+    dropout_rate: dropout rate, dropout is fused into the cuDNN kernel.
+    split_kv: whether to split long key/value sequences into chunks that are
+    attended in parallel when batch * num_heads is too small to fill the GPU
+    (flash attention without bias, mask, causal mask or dropout only). The
+    number of chunks is derived from the SM count of the first local GPU at
+    trace time, so leave it off when exporting or compiling for another GPU.
+    The partial outputs are rounded to the input dtype before they are merged
+    in float32, so results differ slightly from the unsplit kernel.
   Returns:
     Output of shape `[batch, q_length, num_heads, v_depth_per_head]`.
   """
   # check if query, key and value layout meets cuDNN layout requirement
   check_qkv_layout(query, key, value)
   # check if flash attention is supported for this attention pattern
-  is_flash_attention, is_cross_attention = check_is_flash_attention(query, key)
-  # check if cuDNN is installed and if cuDNN version is sufficient
-  check_cudnn_version(is_flash_attention, is_cross_attention)
+  is_flash_attention, _ = check_is_flash_attention(query, key, is_causal_mask)
   if mask is not None and is_causal_mask:
     raise ValueError("can not apply a mask and generate a causal_mask at the same time.")
-  if not is_flash_attention and is_causal_mask:
-    raise ValueError("can only generate a causal_mask with flash attention.")
+  if not 0. <= dropout_rate < 1.:
+    raise ValueError(f"dropout_rate should be in [0, 1), but got {dropout_rate}.")
+  if dropout_rate > 0 and cuda_versions is None:
+    raise NotImplementedError("Dropout is only supported by the cuDNN lowering.")
   variadic_args = (bias is not None, mask is not None)
   if bias is None:
     bias = jnp.zeros(0, dtype=query.dtype)
@@ -747,5 +935,5 @@ def dot_product_attention(query: Array,
   output = _dot_product_attention(
     query, key, value, bias, mask,
     scale, seed, dropout_rate, variadic_args,
-    is_flash_attention, is_causal_mask)
+    is_flash_attention, is_causal_mask, split_kv)
   return output
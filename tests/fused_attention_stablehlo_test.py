@@ -15,6 +15,7 @@
 from functools import partial
 from absl.testing import absltest
 from typing import Optional
+from unittest import mock
 import os
 os.environ['XLA_FLAGS'] = '--xla_gpu_enable_cudnn_fmha=true --xla_gpu_fused_attention_use_cudnn_rng=true'
 
@@ -25,6 +26,7 @@ from jax.sharding import Mesh
 from jax.sharding import PartitionSpec, NamedSharding
 from jax._src import config
 from jax._src import test_util as jtu
+from jax._src.cudnn import fused_attention_stablehlo
 from jax._src.cudnn.fused_attention_stablehlo import dot_product_attention
 
 config.parse_flags_with_absl()
@@ -38,12 +40,14 @@ def sdpa_train(query: Array,
             mask: Optional[Array] = None,
             scale: float = 0.5,
             is_causal_mask: bool = False,
-            dropout_rate: float = 0.1) -> Array:
+            dropout_rate: float = 0.1,
+            split_kv: bool = False) -> Array:
   if mask is not None:
     # convert bool mask to dtype mask
     mask = mask.astype(query.dtype)
   out, sdpa_vjp = jax.vjp(
-    partial(dot_product_attention, scale=scale, is_causal_mask=is_causal_mask, dropout_rate=dropout_rate),
+    partial(dot_product_attention, scale=scale, is_causal_mask=is_causal_mask,
+            dropout_rate=dropout_rate, split_kv=split_kv),
     query, key, value, bias, mask)
   query_grad, key_grad, value_grad, _, _ = sdpa_vjp(grad)
   return out, (query_grad, key_grad, value_grad)
@@ -118,7 +122,7 @@ class DotProductAttentionTest(jtu.JaxTestCase):
       head_dim=[64, 128],
       use_bias=[False, True],
       use_mask=[False, True],
-      is_causal_mask=[False],
+      is_causal_mask=[False, True],
       dropout_rate=[0, 0.5],
       scale=[0.5],
       dtype=[jnp.float16, jnp.bfloat16]
@@ -127,10 +131,8 @@ class DotProductAttentionTest(jtu.JaxTestCase):
   def test_sdpa(self, batch_size: int, seq_len: int, num_heads: int,
                 head_dim: int, use_bias: bool, use_mask: bool, is_causal_mask: bool,
                 dropout_rate: float, scale: float, dtype: jnp.dtype):
-    if seq_len == 256 and is_causal_mask:
-      self.skipTest("Fused attention does not support mask generation.")
-    if seq_len == 256 and head_dim == 128:
-      self.skipTest("Fused attention does not support head dim = 128.")
+    if is_causal_mask and (use_bias or use_mask):
+      self.skipTest("Causal mask generation is only tested without bias or mask.")
     if len(jax.local_devices()) <= 4:
       self.skipTest("Require at least 4 devices to run sharding tests.")
 
@@ -194,7 +196,7 @@ class DotProductAttentionTest(jtu.JaxTestCase):
       out, (query_grad, key_grad, value_grad) = jitted_sdpa_train(query, key, value, grad, bias, mask)
       out_ref, (query_grad_ref, key_grad_ref, value_grad_ref) = jitted_sdpa_train_ref(query, key, value, grad, bias, mask)
       self.assertArraysAllClose(out_ref, out, rtol=1e-5, atol=1e-5)
-      if seq_len > 512:
+      if seq_len > 512 or head_dim == 128 or is_causal_mask:
         # query_grad in flash attention is not deterministic
         self.assertArraysAllClose(query_grad_ref, query_grad, rtol=1e-2, atol=1e-2)
       else:
@@ -202,5 +204,139 @@ class DotProductAttentionTest(jtu.JaxTestCase):
       self.assertArraysAllClose(key_grad_ref, key_grad, rtol=1e-5, atol=1e-5)
       self.assertArraysAllClose(value_grad_ref, value_grad, rtol=1e-5, atol=1e-5)
 
+  @jtu.sample_product(
+      seq_len=[256, 1024],
+      dtype=[jnp.float16, jnp.bfloat16]
+  )
+  @jtu.run_on_devices("cpu", "cuda")
+  def test_sdpa_vmap_shared_kv(self, seq_len: int, dtype: jnp.dtype):
+    # a batch of queries attending to the same key and value
+    k1, k2, k3, k4 = jax.random.split(jax.random.key(0), 4)
+    query = jax.random.normal(k1, (3, 2, seq_len, 4, 64), dtype=dtype)
+    key = jax.random.normal(k2, (2, seq_len, 4, 64), dtype=dtype)
+    value = jax.random.normal(k3, (2, seq_len, 4, 64), dtype=dtype)
+    grad = jax.random.normal(k4, (3, 2, seq_len, 4, 64), dtype=dtype)
+
+    def vmap_train(attention, query, key, value, grad):
+      # key and value cotangents are summed over the broadcast batch axis
+      out, vmap_vjp = jax.vjp(
+        jax.vmap(attention, in_axes=(0, None, None)), query, key, value)
+      return out, vmap_vjp(grad)
+
+    sdpa = partial(dot_product_attention, scale=0.5)
+    ref = partial(sdpa_ref, scale=0.5, dropout_rate=0.)
+    out, grads = jax.jit(partial(vmap_train, sdpa))(query, key, value, grad)
+    # both the cuDNN kernels and the cpu fallback accumulate in float32, so
+    # compare against a float32 reference, 2e-2 covers the fp16/bf16 rounding
+    # of outputs and of key/value grads summed over the vmapped queries
+    upcast = lambda x: x.astype(jnp.float32)
+    out_ref, grads_ref = jax.jit(partial(vmap_train, ref))(
+      *map(upcast, (query, key, value, grad)))
+    self.assertArraysAllClose(out_ref.astype(dtype), out, rtol=2e-2, atol=2e-2)
+    for grad_ref, grad in zip(grads_ref, grads):
+      self.assertArraysAllClose(grad_ref.astype(dtype), grad, rtol=2e-2, atol=2e-2)
+
+  @jtu.sample_product(
+      batch_size=[1, 2],
+      dtype=[jnp.float16, jnp.bfloat16]
+  )
+  @jtu.run_on_devices("cuda")
+  def test_sdpa_split_kv(self, batch_size: int, dtype: jnp.dtype):
+    # small batch decoding shape that is split along kv_seq
+    k1, k2, k3, k4 = jax.random.split(jax.random.key(0), 4)
+    query = jax.random.normal(k1, (batch_size, 128, 4, 64), dtype=dtype)
+    key = jax.random.normal(k2, (batch_size, 4096, 4, 64), dtype=dtype)
+    value = jax.random.normal(k3, (batch_size, 4096, 4, 64), dtype=dtype)
+    grad = jax.random.normal(k4, (batch_size, 128, 4, 64), dtype=dtype)
+    jitted_sdpa_train = jax.jit(partial(sdpa_train, dropout_rate=0., split_kv=True))
+    jitted_sdpa_train_ref = jax.jit(partial(sdpa_train_ref, dropout_rate=0.))
+    # pin the factor so the split does not depend on the SM count of the GPU
+    with mock.patch.object(fused_attention_stablehlo, "get_split_kv_factor",
+                           return_value=4):
+      hlo = jitted_sdpa_train.lower(query, key, value, grad).as_text()
+      out, (query_grad, key_grad, value_grad) = jitted_sdpa_train(query, key, value, grad)
+    # kv chunks are folded into the batch dim of the forward call
+    self.assertIn(f"tensor<{batch_size * 4}x1024x4x64x", hlo)
+    out_ref, (query_grad_ref, key_grad_ref, value_grad_ref) = jitted_sdpa_train_ref(query, key, value, grad)
+    # looser than test_sdpa since the partial outputs are rounded to fp16/bf16
+    # before they are merged
+    self.assertArraysAllClose(out_ref, out, rtol=1e-2, atol=1e-2)
+    self.assertArraysAllClose(query_grad_ref, query_grad, rtol=1e-2, atol=1e-2)
+    self.assertArraysAllClose(key_grad_ref, key_grad, rtol=1e-2, atol=1e-2)
+    self.assertArraysAllClose(value_grad_ref, value_grad, rtol=1e-2, atol=1e-2)
+
+  @jtu.sample_product(
+      seq_len=[256, 1024],
+      use_bias=[False, True],
+      use_mask=[False, True],
+      is_causal_mask=[False, True],
+      dtype=[jnp.float16, jnp.bfloat16]
+  )
+  @jtu.run_on_devices("cpu")
+  def test_sdpa_cpu_fallback(self, seq_len: int, use_bias: bool, use_mask: bool,
+                             is_causal_mask: bool, dtype: jnp.dtype):
+    if is_causal_mask and (use_bias or use_mask):
+      self.skipTest("Causal mask generation is only tested without bias or mask.")
+    k1, k2, k3, k4, k5 = jax.random.split(jax.random.key(0), 5)
+    shape = (2, seq_len, 2, 64)
+    query = jax.random.normal(k1, shape, dtype=dtype)
+    key = jax.random.normal(k2, shape, dtype=dtype)
+    value = jax.random.normal(k3, shape, dtype=dtype)
+    grad = jax.random.normal(k4, shape, dtype=dtype)
+    bias = jax.random.normal(k5, (2, 2, seq_len, seq_len), dtype=dtype) if use_bias else None
+    mask = jax.random.bernoulli(k5, 0.5, (2, 2, seq_len, seq_len)) if use_mask else None
+    jitted_sdpa_train = jax.jit(
+      partial(sdpa_train, is_causal_mask=is_causal_mask, dropout_rate=0.))
+    jitted_sdpa_train_ref = jax.jit(
+      partial(sdpa_train_ref, is_causal_mask=is_causal_mask, dropout_rate=0.))
+    out, grads = jitted_sdpa_train(query, key, value, grad, bias, mask)
+    # the fallback accumulates in float32, so compare against a float32 reference
+    upcast = lambda x: None if x is None else x.astype(jnp.float32)
+    out_ref, grads_ref = jitted_sdpa_train_ref(
+      *map(upcast, (query, key, value, grad, bias)), mask)
+    self.assertArraysAllClose(out_ref.astype(dtype), out, rtol=2e-2, atol=2e-2)
+    for grad_ref, grad in zip(grads_ref, grads):
+      self.assertArraysAllClose(grad_ref.astype(dtype), grad, rtol=2e-2, atol=2e-2)
+
+  def test_sdpa_unsupported_seq_len(self):
+    # flash attention needs sequence lengths that are multiples of 64
+    query = jnp.zeros((2, 100, 4, 128), dtype=jnp.float16)
+    with self.assertRaisesRegex(NotImplementedError, "Unsupported sequence length"):
+      dot_product_attention(query, query, query)
+    with self.assertRaisesRegex(NotImplementedError, "Unsupported sequence length"):
+      dot_product_attention(query[..., :64], query[..., :64], query[..., :64],
+                            is_causal_mask=True)
+
+  @jtu.sample_product(
+      dtype=[jnp.float8_e4m3fn, jnp.float8_e5m2]
+  )
+  def test_sdpa_fp8_unsupported(self, dtype: jnp.dtype):
+    query = jnp.zeros((2, 1024, 4, 64), dtype=dtype)
+    with self.assertRaisesRegex(NotImplementedError, "fp8 fused attention"):
+      dot_product_attention(query, query, query)
+
+  def test_sdpa_compute_capability_unsupported(self):
+    # fused attention kernels need Ampere or newer
+    device = mock.Mock(compute_capability="7.0")
+    with mock.patch.object(fused_attention_stablehlo, "_get_local_gpu",
+                           return_value=device):
+      with self.assertRaisesRegex(RuntimeError, "compute capability >= 8.0"):
+        fused_attention_stablehlo.check_compute_capability((8, 0))
+
+  @jtu.sample_product(
+      dropout_rate=[-0.1, 1.0]
+  )
+  def test_sdpa_invalid_dropout_rate(self, dropout_rate: float):
+    query = jnp.zeros((2, 256, 4, 64), dtype=jnp.float16)
+    with self.assertRaisesRegex(ValueError, "dropout_rate should be in"):
+      dot_product_attention(query, query, query, dropout_rate=dropout_rate)
+
+  def test_sdpa_dropout_without_cudnn(self):
+    # the XLA fallback has no dropout, reject it before lowering
+    query = jnp.zeros((2, 256, 4, 64), dtype=jnp.float16)
+    with mock.patch.object(fused_attention_stablehlo, "cuda_versions", None):
+      with self.assertRaisesRegex(NotImplementedError, "Dropout is only supported"):
+        dot_product_attention(query, query, query, dropout_rate=0.1)
+
 if __name__ == '__main__':
   absltest.main(testLoader=jtu.JaxTestLoader())